@@ -8,15 +8,18 @@ Module to query the Canadian Astronomy Data Centre (CADC).
 """
 
 import logging
+import threading
 import warnings
 import requests
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+import numpy as np
 from numpy import ma
-from urllib.parse import urlencode
+from urllib.parse import quote, urlencode
 
 from ..utils.class_or_instance import class_or_instance
 from ..utils import async_to_sync, commons
 from ..query import BaseQuery
-from bs4 import BeautifulSoup
 from astropy.utils.exceptions import AstropyDeprecationWarning
 from astroquery.utils.decorators import deprecated
 from astropy import units as u
@@ -38,6 +41,22 @@ __all__ = ['Cadc', 'CadcClass']
 
 CADC_COOKIE_PREFIX = 'CADC_SSO'
 
+# maximum number of simultaneous requests (datalink or file downloads)
+MAX_DATALINK_WORKERS = 8
+
+# constant query templates so that the service can recognize (and
+# potentially cache the plan of) repeated queries
+_NAME_QUERY_TMPL = \
+    "select * from caom2.Observation o join caom2.Plane p " \
+    "on o.obsID=p.obsID where lower(target_name) like '%{}%'"
+
+_REGION_QUERY_TMPL = \
+    "SELECT * from caom2.Observation o join caom2.Plane p " \
+    "ON o.obsID=p.obsID " \
+    "WHERE INTERSECTS( " \
+    "CIRCLE('ICRS', {ra}, {dec}, {radius}), position_bounds) = 1 AND " \
+    "(quality_flag IS NULL OR quality_flag != 'junk')"
+
 logger = logging.getLogger(__name__)
 
 # TODO figure out what to do if anything about them. Some might require
@@ -106,10 +125,42 @@ class CadcClass(BaseQuery):
 
         super(CadcClass, self).__init__()
         self.baseurl = url
+        # session shared by the datalink calls so that keep-alive
+        # connections are reused rather than paying a TLS handshake
+        # per request
+        self._datalink_session = requests.Session()
+        self._datalink_session.mount(
+            'https://', requests.adapters.HTTPAdapter(
+                pool_connections=10, pool_maxsize=20, max_retries=1))
         if auth_session:
             self._auth_session = auth_session
         else:
             self._auth_session = None
+        self._tables_cache = None
+        self._tables_map = None
+        self._tap_prefetch_started = False
+
+    def _prefetch_tap_url(self):
+        """
+        Resolve the TAP service url in a background thread so that the
+        registry fetches overlap with argument parsing in the query
+        methods. Started at most once per instance, and only from the
+        query methods - never at instantiation, so importing the module
+        (which creates the `Cadc` singleton) stays network free.
+        """
+        if self.baseurl is not None or self._tap_prefetch_started:
+            return
+        self._tap_prefetch_started = True
+
+        def resolve():
+            try:
+                get_access_url(self.CADCTAP_SERVICE_URI)
+            except Exception:
+                # results land in the get_access_url cache; errors are
+                # reported by the blocking lookup in cadctap instead
+                pass
+
+        threading.Thread(target=resolve, daemon=True).start()
 
     @property
     def cadctap(self):
@@ -255,6 +306,10 @@ class CadcClass(BaseQuery):
                           '`astropy.units.Quantity`')
             radius = radius * u.deg
 
+        if not get_query_payload:
+            # overlap the TAP url lookup with the coordinate parsing
+            # below; payload-only calls never touch the network
+            self._prefetch_tap_url()
         request_payload = self._args_to_payload(coordinates=coordinates,
                                                 radius=radius,
                                                 collection=collection)
@@ -265,6 +320,58 @@ class CadcClass(BaseQuery):
         response = self.exec_sync(request_payload['query'])
         return response
 
+    @class_or_instance
+    def query_region(self, coordinates, radius=0.016666666666667*u.deg,
+                     collection=None,
+                     get_query_payload=False):
+        """
+        Queries the CADC for a region around the specified coordinates.
+
+        The query runs synchronously and its response is already a
+        fully-materialized table, so this bypasses the generic
+        async-to-sync wrapping (and its no-op result re-parsing).
+
+        Parameters
+        ----------
+        coordinates : str or `astropy.coordinates`.
+            coordinates around which to query
+        radius : str or `astropy.units.Quantity`.
+            the radius of the cone search
+        collection: Name of the CADC collection to query, optional
+        get_query_payload : bool, optional
+            Just return the dict of HTTP request parameters.
+
+        Returns
+        -------
+        response : `~astropy.table.Table`
+            Results of the query in a tabular format.
+        """
+        return self.query_region_async(coordinates, radius=radius,
+                                       collection=collection,
+                                       get_query_payload=get_query_payload)
+
+    @class_or_instance
+    def query_name(self, name):
+        """
+        Query CADC metadata for a name and return the corresponding metadata
+        in the CAOM2 format (http://www.opencadc.org/caom2/).
+
+        The query runs synchronously and its response is already a
+        fully-materialized table, so this bypasses the generic
+        async-to-sync wrapping (and its no-op result re-parsing).
+
+        Parameters
+        ----------
+        name: str
+                name of object to query for
+
+        Returns
+        -------
+        response : `~astropy.table.Table`
+            Results of the query in a tabular format.
+        """
+        return self.query_name_async(name)
+
     @class_or_instance
     def query_name_async(self, name):
         """
@@ -282,10 +389,10 @@ class CadcClass(BaseQuery):
             Results of the query in a tabular format.
 
         """
+        # escape single quotes in the name - ADQL has no bind parameters
+        # in pyvo's sync interface, so the value is inlined in the query
         response = self.exec_sync(
-            "select * from caom2.Observation o join caom2.Plane p "
-            "on o.obsID=p.obsID where lower(target_name) like '%{}%'".
-            format(name.lower()))
+            _NAME_QUERY_TMPL.format(name.lower().replace("'", "''")))
         return response
 
     @class_or_instance
@@ -300,18 +407,20 @@ class CadcClass(BaseQuery):
         """
         response = self.exec_sync(
             'select distinct collection, energy_emBand from caom2.EnumField')
+        # group the bands by collection in numpy rather than iterating
+        # over the table rows in Python
+        collection_col = np.asarray(response['collection'])
+        band_col = np.asarray(response['energy_emBand'])
+        band_mask = ma.getmaskarray(ma.asanyarray(response['energy_emBand']))
+        unique_collections, inverse = np.unique(collection_col,
+                                                return_inverse=True)
         collections = {}
-        for row in response:
-            if row['collection'] not in collections:
-                collection = {
-                    'Description': 'The {} collection at the CADC'.
-                    format(row['collection']), 'Bands': []}
-                if row['energy_emBand'] is not ma.masked:
-                    collection['Bands'].append(row['energy_emBand'])
-                collections[row['collection']] = collection
-            elif row['energy_emBand'] is not ma.masked:
-                collections[row['collection']]['Bands'].\
-                    append(row['energy_emBand'])
+        for index, collection in enumerate(unique_collections):
+            bands = band_col[(inverse == index) & ~band_mask]
+            collections[str(collection)] = {
+                'Description':
+                    'The {} collection at the CADC'.format(collection),
+                'Bands': bands.tolist()}
         return collections
 
     @class_or_instance
@@ -350,17 +459,25 @@ class CadcClass(BaseQuery):
         if get_url_list:
             return filenames
 
-        images = []
+        if not filenames:
+            return []
 
-        for fn in filenames:
+        def get_fits(fn):
             try:
-                images.append(fn.get_fits())
+                return fn.get_fits()
             except requests.exceptions.HTTPError as err:
                 # Catch HTTPError if user is unauthorized to access file
                 logger.debug(
                     "{} - Problem retrieving the file: {}".
                     format(str(err), str(err.url)))
-                pass
+                return None
+
+        # the files are independent downloads so fetch them in parallel
+        with ThreadPoolExecutor(
+                max_workers=min(MAX_DATALINK_WORKERS,
+                                len(filenames))) as executor:
+            images = [image for image in executor.map(get_fits, filenames)
+                      if image is not None]
 
         return images
 
@@ -389,6 +506,12 @@ class CadcClass(BaseQuery):
         -------
         list : A list of context-managers that yield readable file-like objects
         """
+        # overlap the TAP url lookup with the coordinate parsing below
+        self._prefetch_tap_url()
+        # parse the coordinates once here - both _args_to_payload and
+        # get_image_list accept the parsed object as is, so the string
+        # parse (and possible name resolution) is not repeated
+        coordinates = commons.parse_coordinates(coordinates).fk5
         request_payload = self._args_to_payload(coordinates=coordinates,
                                                 radius=radius,
                                                 collection=collection,
@@ -440,37 +563,49 @@ class CadcClass(BaseQuery):
         radius_deg = commons.radius_to_unit(radius, unit='degree')
         ra = parsed_coordinates.ra.degree
         dec = parsed_coordinates.dec.degree
-        cutout_params = {'POS': 'CIRCLE {} {} {}'.format(ra, dec, radius_deg)}
+        # the cutout position is the same for every url so quote it once
+        # here rather than urlencoding a dict per service_def below
+        pos_query = 'POS=' + quote(
+            'CIRCLE {} {} {}'.format(ra, dec, radius_deg), safe='')
 
         try:
             publisher_ids = query_result['publisherID']
         except KeyError:
             raise AttributeError(
                 'publisherID column missing from query_result argument')
+        # iterate over a plain list rather than an astropy Column, whose
+        # item access and slicing carry masking overhead
+        publisher_ids = np.asarray(publisher_ids).tolist()
 
         result = []
 
         # Send datalink requests in batches of 20 publisher ids
         batch_size = 20
 
+        # resolve the datalink endpoint once rather than going through
+        # the property for every chunk
+        data_link_url = self.data_link_url
+
         # Iterate through list of sublists to send datalink requests in batches
-        for pid_sublist in (publisher_ids[pos:pos + batch_size] for pos in
-                            range(0, len(publisher_ids), batch_size)):
+        for pid_sublist in chunks(publisher_ids, batch_size):
+            id_query = '&'.join('ID=' + _quote_value(pid)
+                                for pid in pid_sublist)
             datalink = pyvo.dal.adhoc.DatalinkResults.from_result_url(
-                '{}?{}'.format(self.data_link_url,
-                               urlencode({'ID': pid_sublist}, True)))
+                '{}?{}'.format(data_link_url, id_query),
+                session=self._datalink_session)
             for service_def in datalink.bysemantics('#cutout'):
                 access_url = service_def.access_url
                 if isinstance(access_url, bytes):  # ASTROPY_LT_4_1
                     access_url = access_url.decode('ascii')
                 if '/sync' in access_url:
-                    service_params = service_def.input_params
-                    input_params = {param.name: param.value
-                                    for param in service_params if
-                                    param.name in ['ID', 'RUNID']}
-                    input_params.update(cutout_params)
+                    query_parts = [
+                        '{}={}'.format(param.name,
+                                       _quote_value(param.value))
+                        for param in service_def.input_params
+                        if param.name in ('ID', 'RUNID')]
+                    query_parts.append(pos_query)
                     result.append('{}?{}'.format(access_url,
-                                                 urlencode(input_params)))
+                                                 '&'.join(query_parts)))
 
         return result
 
@@ -512,20 +647,39 @@ class CadcClass(BaseQuery):
         except KeyError:
             raise AttributeError(
                 'publisherID column missing from query_result argument')
+        # iterate over a plain list rather than an astropy Column, whose
+        # item access and slicing carry masking overhead
+        publisher_ids = np.asarray(publisher_ids).tolist()
         result = []
         # Send datalink requests in batches of 20 publisher ids
         batch_size = 20
 
-        # Iterate through list of sublists to send datalink requests in batches
-        for pid_sublist in (publisher_ids[pos:pos + batch_size] for pos in
-                            range(0, len(publisher_ids), batch_size)):
-            # REQUEST=download-only is a CADC optimization to restrict
-            # results to downloadable URLs as opposed to redirects
-            # to other services such as cutouts that are not required
-            datalink = pyvo.dal.adhoc.DatalinkResults.from_result_url(
-                '{}?{}'.format(self.data_link_url,
-                               urlencode({'ID': pid_sublist,
-                                          'REQUEST': 'downloads-only'}, True)))
+        # resolve the datalink endpoint once rather than going through
+        # the property for every chunk
+        data_link_url = self.data_link_url
+
+        # REQUEST=download-only is a CADC optimization to restrict
+        # results to downloadable URLs as opposed to redirects
+        # to other services such as cutouts that are not required
+        batch_urls = [
+            '{}?{}'.format(data_link_url,
+                           urlencode({'ID': pid_sublist,
+                                      'REQUEST': 'downloads-only'}, True))
+            for pid_sublist in chunks(publisher_ids, batch_size)]
+
+        if not batch_urls:
+            return result
+
+        # datalink requests are independent so send them in parallel.
+        # executor.map preserves the order of the batches in the results
+        with ThreadPoolExecutor(
+                max_workers=min(MAX_DATALINK_WORKERS,
+                                len(batch_urls))) as executor:
+            datalink_results = executor.map(
+                lambda url: pyvo.dal.adhoc.DatalinkResults.from_result_url(
+                    url, session=self._datalink_session), batch_urls)
+
+        for datalink in datalink_results:
             for service_def in datalink:
                 if service_def.semantics == 'http://www.openadc.org/caom2#pkg':
                     # pkg is an alternative for downloading multiple
@@ -555,11 +709,14 @@ class CadcClass(BaseQuery):
         """
         if verbose is not None:
             warnings.warn('verbose deprecated since 0.4.0')
-        table_set = self.cadctap.tables
+        if self._tables_cache is None:
+            # one VOSI-tables fetch per instance; use refresh_tables to
+            # re-fetch
+            self._tables_cache = self.cadctap.tables
         if only_names:
-            return list(table_set.keys())
+            return list(self._tables_cache.keys())
         else:
-            return list(table_set.values())
+            return list(self._tables_cache.values())
 
     def get_table(self, table, verbose=None):
         """
@@ -577,10 +734,17 @@ class CadcClass(BaseQuery):
         """
         if verbose is not None:
             warnings.warn('verbose deprecated since 0.4.0')
-        tables = self.get_tables()
-        for t in tables:
-            if table == t.name:
-                return t
+        if self._tables_map is None:
+            self._tables_map = {t.name: t for t in self.get_tables()}
+        return self._tables_map.get(table)
+
+    def refresh_tables(self):
+        """
+        Discard the cached table metadata so that the next call to
+        `get_tables` or `get_table` re-fetches it from the service.
+        """
+        self._tables_cache = None
+        self._tables_map = None
 
     def exec_sync(self, query, maxrec=None, uploads=None, output_file=None):
         """
@@ -753,23 +917,37 @@ class CadcClass(BaseQuery):
         # interchangeable) since RA/Dec are used below
         coordinates = commons.parse_coordinates(kwargs['coordinates']).fk5
         radius_deg = commons.radius_to_unit(kwargs['radius'], unit='degree')
-        payload = {format: 'VOTable'}
-        payload['query'] = \
-            "SELECT * from caom2.Observation o join caom2.Plane p " \
-            "ON o.obsID=p.obsID " \
-            "WHERE INTERSECTS( " \
-            "CIRCLE('ICRS', {}, {}, {}), position_bounds) = 1 AND " \
-            "(quality_flag IS NULL OR quality_flag != 'junk')".\
-            format(coordinates.ra.degree, coordinates.dec.degree, radius_deg)
+        payload = {'format': 'VOTable'}
+        query = _REGION_QUERY_TMPL.format(ra=coordinates.ra.degree,
+                                          dec=coordinates.dec.degree,
+                                          radius=radius_deg)
         if 'collection' in kwargs and kwargs['collection']:
-            payload['query'] = "{} AND collection='{}'".\
-                format(payload['query'], kwargs['collection'])
+            query = "{} AND collection='{}'".format(query,
+                                                    kwargs['collection'])
         if 'data_product_type' in kwargs and kwargs['data_product_type']:
-            payload['query'] = "{} AND dataProductType='{}'".\
-                format(payload['query'], kwargs['data_product_type'])
+            query = "{} AND dataProductType='{}'".format(
+                query, kwargs['data_product_type'])
+        payload['query'] = query
         return payload
 
 
+def _quote_value(value):
+    """Percent-encode a query parameter value, decoding bytes first."""
+    if isinstance(value, bytes):  # ASTROPY_LT_4_1
+        value = value.decode('ascii')
+    return quote(str(value), safe='')
+
+
+def chunks(obj_list, chunk_len):
+    """Yield successive chunk_len-sized sublists of obj_list."""
+    iterator = iter(obj_list)
+    while True:
+        chunk = list(islice(iterator, chunk_len))
+        if not chunk:
+            return
+        yield chunk
+
+
 def static_vars(**kwargs):
     def decorate(func):
         for k in kwargs:
@@ -778,7 +956,7 @@ def static_vars(**kwargs):
     return decorate
 
 
-@static_vars(caps={})
+@static_vars(caps={}, access_urls={}, lock=threading.Lock())
 def get_access_url(service, capability=None):
     """
     Returns the URL corresponding to a service by doing a lookup in the cadc
@@ -795,9 +973,19 @@ def get_access_url(service, capability=None):
     This function implements the functionality of a CADC registry as defined
     by the IVOA. It should be eventually moved to its own directory.
 
-    Caching should be considered to reduce the number of remote calls to
-    CADC registry
+    Access urls are cached (keyed by service and capability) so that repeat
+    lookups do not re-fetch and re-parse the capabilities documents. The
+    caches are shared with the background prefetch thread, so the whole
+    resolution runs under a lock: concurrent callers serialize and the
+    later one is served from the cache.
     """
+    with get_access_url.lock:
+        return _resolve_access_url(service, capability)
+
+
+def _resolve_access_url(service, capability):
+    if (service, capability) in get_access_url.access_urls:
+        return get_access_url.access_urls[(service, capability)]
 
     caps_url = ''
     if service.startswith('http'):
@@ -814,11 +1002,11 @@ def get_access_url(service, capability=None):
                 logger.debug(
                     "ERROR getting the CADC registry: {}".format(str(err)))
                 raise err
-            for line in response.text.splitlines():
-                if len(line) > 0 and not line.startswith('#'):
-                    service_id, capabilies_url = line.split('=')
-                    get_access_url.caps[service_id.strip()] = \
-                        capabilies_url.strip()
+            get_access_url.caps.update(
+                (service_id.strip(), capabilities_url.strip())
+                for service_id, capabilities_url in
+                (line.split('=', 1) for line in response.text.splitlines()
+                 if line and not line.startswith('#')))
         # lookup the service
         service_uri = service
         if not service.startswith('ivo'):
@@ -830,6 +1018,7 @@ def get_access_url(service, capability=None):
         # look up in the CADC reg for the service capabilities
         caps_url = get_access_url.caps[service_uri]
         if not capability:
+            get_access_url.access_urls[(service, capability)] = caps_url
             return caps_url
     try:
         response2 = requests.get(caps_url)
@@ -839,17 +1028,32 @@ def get_access_url(service, capability=None):
             "ERROR getting the service capabilities: {}".format(str(e)))
         raise e
 
-    soup = BeautifulSoup(response2.text, features="html5lib")
-    for cap in soup.find_all('capability'):
-        if cap.get("standardid", None) == capability:
-            if len(cap.find_all('interface')) == 1:
-                return cap.find_all('interface')[0].accessurl.text
-            for i in cap.find_all('interface'):
-                if hasattr(i, 'securitymethod'):
-                    sm = i.securitymethod
-                    if not sm or sm.get("standardid", None) is None or\
-                       sm['standardid'] == "ivo://ivoa.net/sso#cookie":
-                        return i.accessurl.text
+    # deferred so that importing the module does not pay for lxml;
+    # repeated calls are typically served from the cache above anyway
+    from lxml import etree
+
+    # capabilities documents are well-formed XML, so parse with lxml and
+    # select the anonymous or cookie interface of the capability with a
+    # single XPath evaluation instead of walking the tags in Python
+    root = etree.fromstring(response2.content)
+    access_urls = root.xpath(
+        ".//capability[@standardID=$sid]/interface["
+        "not(securityMethod) or not(securityMethod/@standardID) or "
+        "securityMethod/@standardID='ivo://ivoa.net/sso#cookie']"
+        "/accessURL/text()", sid=capability)
+    if access_urls:
+        access_url = access_urls[0]
+        get_access_url.access_urls[(service, capability)] = access_url
+        return access_url
+    # fall back for a capability whose single interface only advertises
+    # other security methods
+    for cap in root.iter('capability'):
+        if cap.get('standardID') == capability:
+            interfaces = cap.findall('interface')
+            if len(interfaces) == 1:
+                access_url = interfaces[0].findtext('accessURL')
+                get_access_url.access_urls[(service, capability)] = access_url
+                return access_url
     raise RuntimeError("ERROR - capability {} not found or not working with "
                        "anonymous or cookie access".format(capability))
 
@@ -12,8 +12,8 @@ from astropy.table import Table as AstroTable
 from astropy.io.fits.hdu.hdulist import HDUList
 from astropy.io.votable.tree import VOTableFile, Resource, Table, Field
 from astropy.io.votable import parse
-from six import BytesIO
-from six.moves.urllib_parse import urlsplit, parse_qs
+from io import BytesIO
+from urllib.parse import urlsplit, parse_qs
 from astroquery.utils.commons import parse_coordinates, FileContainer
 from astropy import units as u
 from astropy.utils.exceptions import AstropyDeprecationWarning
@@ -78,6 +78,23 @@ def test_get_table():
         assert cadc.get_table('foo') is None
 
 
+@patch('astroquery.cadc.core.get_access_url',
+       Mock(side_effect=lambda x: 'https://some.url'))
+@pytest.mark.skipif(not pyvo_OK, reason='not pyvo_OK')
+def test_query_name():
+    cadc = Cadc()
+
+    def mock_exec_sync(query):
+        assert query == \
+            "select * from caom2.Observation o join caom2.Plane p " \
+            "on o.obsID=p.obsID where lower(target_name) like '%o''brien%'"
+        return AstroTable()
+    cadc.exec_sync = mock_exec_sync
+    # the name is lowercased and single quotes are escaped before being
+    # inlined in the query
+    cadc.query_name_async("O'Brien")
+
+
 @patch('astroquery.cadc.core.get_access_url',
        Mock(side_effect=lambda x: 'https://some.url'))
 @pytest.mark.skipif(not pyvo_OK, reason='not pyvo_OK')
@@ -168,8 +185,10 @@ def test_auth():
         '"{}"'.format(cookie)
 
 
-# make sure that caps is reset at the end of the test
+# make sure that caps and the access url cache are reset at the end of
+# the test
 @patch('astroquery.cadc.core.get_access_url.caps', {})
+@patch('astroquery.cadc.core.get_access_url.access_urls', {})
 @pytest.mark.skipif(not pyvo_OK, reason='not pyvo_OK')
 def test_get_access_url():
     # testing implementation of requests.get method:
@@ -184,7 +203,7 @@ def test_get_access_url():
         class CapabilitiesResponse:
             def __init__(self):
                 caps_file = data_path('tap_caps.xml')
-                self.text = open(caps_file, 'r').read()
+                self.content = open(caps_file, 'rb').read()
 
             def raise_for_status(self):
                 pass
@@ -200,6 +219,11 @@ def test_get_access_url():
         assert 'https://www.cadc-ccda.hia-iha.nrc-cnrc.gc.ca/argus/tables' == \
             cadc_core.get_access_url('mytap',
                                      'ivo://ivoa.net/std/VOSI#tables-1.1')
+    # repeated lookups are served from the cache without calls to the
+    # service (requests.get no longer mocked)
+    assert 'https://www.cadc-ccda.hia-iha.nrc-cnrc.gc.ca/argus/tables' == \
+        cadc_core.get_access_url('mytap',
+                                 'ivo://ivoa.net/std/VOSI#tables-1.1')
 
 
 @patch('astroquery.cadc.core.get_access_url',
@@ -326,8 +350,10 @@ def test_get_image_list():
         dl_results_mock.return_value = result
         cadc = Cadc()
         cadc._request = get  # Mock the request
+        # bytes publisher ids (as returned by astropy<4.1 tables) must be
+        # decoded, not str()-ed, when the datalink url is built
         url_list = cadc.get_image_list(
-            {'publisherID': ['ivo://cadc.nrc.ca/foo']}, coords, radius)
+            {'publisherID': [b'ivo://cadc.nrc.ca/foo']}, coords, radius)
 
         assert len(url_list) == 1
 
@@ -386,6 +412,8 @@ def test_exec_sync():
         pass
 
 
+@patch('astroquery.cadc.core.get_access_url',
+       Mock(side_effect=lambda x, y=None: 'https://some.url'))
 @patch('astroquery.cadc.core.CadcClass.exec_sync', Mock())
 @patch('astroquery.cadc.core.CadcClass.get_image_list',
        Mock(side_effect=lambda x, y, z: ['https://some.url']))
@@ -404,6 +432,8 @@ def test_get_images():
         assert isinstance(fits_images[0], HDUList)
 
 
+@patch('astroquery.cadc.core.get_access_url',
+       Mock(side_effect=lambda x, y=None: 'https://some.url'))
 @patch('astroquery.cadc.core.CadcClass.exec_sync', Mock())
 @patch('astroquery.cadc.core.CadcClass.get_image_list',
        Mock(side_effect=lambda x, y, z: ['https://some.url']))